@@ -1,13 +1,15 @@
 import torch
 import random
+import inspect
+import contextlib
 import numpy as np
 
 from tqdm import tqdm
 from torch import nn
-from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
 
 from .utils.attention import scaled_dot_product_attention
-from .utils.dataset import LabeledDataset
 from .utils.revin import RevIN
 from .utils.sam import SAM
 
@@ -15,49 +17,84 @@ from .utils.sam import SAM
 import matplotlib.pyplot as plt
 import seaborn as sns
 
+# The attention implementation is resolved once: the native kernel when available, the reference one otherwise
+if hasattr(nn.functional, 'scaled_dot_product_attention'):
+    _sdpa = nn.functional.scaled_dot_product_attention
+else:
+    _sdpa = scaled_dot_product_attention
+
+
+def _to_numpy(tensors):
+    """
+    Copies a list of tensors to numpy arrays. Tensors living on the same CUDA device are packed into a
+    single flat tensor and moved with one copy, so that there is one sync overall
+    """
+    tensors = [t.detach() for t in tensors]
+    devices = {t.device for t in tensors}
+    if len(devices) != 1 or next(iter(devices)).type != 'cuda':
+        return [t.cpu().numpy() for t in tensors]
+    flat = _flatten_dense_tensors(tensors).cpu()
+    return [t.numpy() for t in _unflatten_dense_tensors(flat, tensors)]
+
+
 class SAMFormerArchitecture(nn.Module):
+    # constant for TorchScript, so that the RevIN branches are resolved when the module is scripted
+    use_revin: torch.jit.Final[bool]
+
     def __init__(self, num_channels, seq_len, hid_dim, pred_horizon, use_revin=True):
         super().__init__()
         self.revin = RevIN(num_features=num_channels)
-        self.compute_keys = nn.Linear(seq_len, hid_dim)
-        self.compute_queries = nn.Linear(seq_len, hid_dim)
-        self.compute_values = nn.Linear(seq_len, seq_len)
+        self.hid_dim = hid_dim
+        self.seq_len = seq_len
+        # Queries, keys and values are computed with a single fused projection
+        self.qkv = nn.Linear(seq_len, 2 * hid_dim + seq_len)
         self.linear_forecaster = nn.Linear(seq_len, pred_horizon)
         self.use_revin = use_revin
 
-    def forward(self, x, flatten_output=True):
+    def forward(self, x, flatten_output: bool = True, reuse_stats: bool = False):
         # RevIN Normalization
         if self.use_revin:
-            x_norm = self.revin(x.transpose(1, 2), mode='norm').transpose(1, 2) # (n, D, L)
+            x_norm = self.revin(x, mode='norm', reuse_stats=reuse_stats) # (n, D, L)
         else:
             x_norm = x
         # Channel-Wise Attention
-        queries = self.compute_queries(x_norm) # (n, D, hid_dim)
-        keys = self.compute_keys(x_norm) # (n, D, hid_dim)
-        values = self.compute_values(x_norm) # (n, D, L)
-        if hasattr(nn.functional, 'scaled_dot_product_attention'):
-            att_score = nn.functional.scaled_dot_product_attention(queries, keys, values) # (n, D, L)
-        else:
-            att_score = scaled_dot_product_attention(queries, keys, values) # (n, D, L)
+        queries, keys, values = self.compute_qkv(x_norm)
+        att_score = _sdpa(queries, keys, values) # (n, D, L)
         out = x_norm + att_score # (n, D, L)
         # Linear Forecasting
-        out = self.linear_forecaster(out) # (n, D, H)
+        n, D, L = out.shape
+        out = self.linear_forecaster(out.reshape(n * D, L)).view(n, D, -1) # (n, D, H)
         # RevIN Denormalization
         if self.use_revin:
-            out = self.revin(out.transpose(1, 2), mode='denorm').transpose(1, 2) # (n, D, H)
+            out = self.revin(out, mode='denorm') # (n, D, H)
         if flatten_output:
             return out.reshape([out.shape[0], out.shape[1]*out.shape[2]])
         else:
             return out
 
+    def compute_qkv(self, x_norm):
+        # The projection is applied to a 2D (n*D, L) matrix so that it runs as a single addmm
+        n, D, L = x_norm.shape
+        qkv = self.qkv(x_norm.reshape(n * D, L)).view(n, D, -1) # (n, D, 2*hid_dim + L)
+        queries, keys, values = qkv.split([self.hid_dim, self.hid_dim, self.seq_len], dim=-1)
+        # The views already have a unit stride on their last dim, so they are passed to SDPA without copies.
+        # SDPA runs its math kernel here because its fused kernels only take 4D (batch, heads, seq, dim) inputs
+        return queries, keys, values # (n, D, hid_dim), (n, D, hid_dim), (n, D, L)
+
 
 class SAMFormer:
     """
     SAMFormer pytorch trainer implemented in the sklearn fashion
     """
     def __init__(self, device='cuda:0', num_epochs=100, batch_size=256, base_optimizer=torch.optim.Adam,
-                 learning_rate=1e-3, weight_decay=1e-5, rho=0.5, use_revin=True, random_state=None):
+                 learning_rate=1e-3, weight_decay=1e-5, rho=0.5, use_revin=True, random_state=None,
+                 use_compile=True, use_amp=True, distributed=False, preload_data=True,
+                 script_inference=False, use_tf32=True):
         self.network = None
+        self._device_type = None
+        self._compiled = False
+        self._orig_network = None
+        self._scripted_network = None
         self.criterion = nn.MSELoss()
         self.device = device
         self.num_epochs = num_epochs
@@ -67,69 +104,181 @@ class SAMFormer:
         self.weight_decay = weight_decay
         self.rho = rho
         self.use_revin = use_revin
+        self.use_compile = use_compile
+        self.use_amp = use_amp
+        self.distributed = distributed
+        self.preload_data = preload_data
+        self.script_inference = script_inference
+        self.use_tf32 = use_tf32
         self.random_state = random_state
 
     def fit(self, x, y):
+        # parsed once here rather than in the per-batch helpers
+        self._device_type = torch.device(self.device).type
+        # TF32 tensor cores for the FP32 GEMMs during training; the process-wide setting is restored afterwards
+        previous_precision = torch.get_float32_matmul_precision()
+        if self.use_tf32 and self._device_type == 'cuda':
+            torch.set_float32_matmul_precision('high')
+        try:
+            self._fit(x, y)
+        finally:
+            torch.set_float32_matmul_precision(previous_precision)
+
+    def _fit(self, x, y):
         if self.random_state is not None:
             torch.manual_seed(self.random_state)
             random.seed(self.random_state)
             np.random.seed(self.random_state)
             torch.cuda.manual_seed_all(self.random_state)
 
-        self.network = SAMFormerArchitecture(num_channels=x.shape[1], seq_len=x.shape[2], hid_dim=16,
-                                             pred_horizon=y.shape[1] // x.shape[1], use_revin=self.use_revin)
+        self._orig_network = SAMFormerArchitecture(num_channels=x.shape[1], seq_len=x.shape[2], hid_dim=16,
+                                                   pred_horizon=y.shape[1] // x.shape[1], use_revin=self.use_revin)
+        self._scripted_network = None
         self.criterion = self.criterion.to(self.device)
-        self.network = self.network.to(self.device)
+        self.network = self._orig_network.to(self.device)
+        if self.distributed:
+            assert torch.distributed.is_available() and torch.distributed.is_initialized(), \
+                "distributed=True requires an initialized process group"
+            device_ids = [self.device] if self._device_type == 'cuda' else None
+            self.network = DistributedDataParallel(self.network, device_ids=device_ids)
         self.network.train()
+        # Under DDP, the gradients of the first SAM pass are discarded by first_step, so they are not all-reduced
+        if isinstance(self.network, DistributedDataParallel):
+            first_pass_context = self.network.no_sync
+        else:
+            first_pass_context = contextlib.nullcontext
+        # The graph is small, so on CUDA kernel launches dominate: fuse them with torch.compile. Batches keep a
+        # single shape (see below) so that the static graphs are not recompiled
+        self._compiled = self.use_compile and hasattr(torch, 'compile') and self._device_type == 'cuda'
+        if self._compiled:
+            self.network = torch.compile(self.network, mode="reduce-overhead", dynamic=False, fullgraph=False)
 
         optimizer = SAM(self.network.parameters(), base_optimizer=self.base_optimizer, rho=self.rho,
-                        lr=self.learning_rate, weight_decay=self.weight_decay)
+                        lr=self.learning_rate, weight_decay=self.weight_decay, **self._base_optimizer_kwargs())
+
+        # The training set is batched by slicing a shuffled index tensor. When it fits on the device, it is uploaded
+        # once; otherwise (preload_data=False) it stays on the host and each batch is copied from pinned memory
+        data_device = self.device if self.preload_data else 'cpu'
+        x_train = torch.as_tensor(x, dtype=torch.float32, device=data_device)
+        y_train = torch.as_tensor(y, dtype=torch.float32, device=data_device)
+        n_samples = x_train.shape[0]
+        n_indices = n_samples
+        loss_sum = torch.zeros((), device=self.device)
 
-        train_dataset = LabeledDataset(x, y)
-        data_loader_train = DataLoader(train_dataset, batch_size=self.batch_size, shuffle=True)
+        if self.distributed:
+            rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+            # every rank walks a shard of the same permutation, padded so that all ranks run as many steps
+            shard_size = (n_samples + world_size - 1) // world_size
+            n_indices = shard_size
+            generator = torch.Generator()
+            seed = self.random_state if self.random_state is not None else 0
+        if self._compiled and n_indices >= self.batch_size:
+            # the partial tail batch is dropped (the permutation changes every epoch, so all samples are still seen)
+            n_indices -= n_indices % self.batch_size
+        n_batches = (n_indices + self.batch_size - 1) // self.batch_size
 
-        progress_bar = tqdm(range(self.num_epochs))
+        progress_bar = tqdm(range(self.num_epochs), disable=self.distributed and rank != 0)
         for epoch in progress_bar:
-            loss_list = []
-            for (x_batch, y_batch) in data_loader_train:
-                x_batch = x_batch.to(self.device)
-                y_batch = y_batch.to(self.device)
-                # =============== forward ===============
-                out_batch = self.network(x_batch)
-                loss = self.criterion(out_batch, y_batch)
-                # =============== backward ===============
+            loss_sum.zero_()
+            if self.distributed:
+                generator.manual_seed(seed + epoch)
+                indices = torch.randperm(n_samples, generator=generator)
+                indices = torch.cat([indices, indices[:shard_size * world_size - n_samples]])
+                indices = indices[rank::world_size].to(data_device)
+            else:
+                indices = torch.randperm(n_samples, device=data_device)
+            for i in range(0, n_indices, self.batch_size):
+                batch_indices = indices[i:i + self.batch_size]
+                x_batch = self._to_device(x_train[batch_indices])
+                y_batch = self._to_device(y_train[batch_indices])
                 if optimizer.__class__.__name__ == 'SAM':
-                    loss.backward()
+                    with first_pass_context():
+                        # =============== forward ===============
+                        with self._autocast():
+                            out_batch = self.network(x_batch)
+                            loss = self.criterion(out_batch, y_batch)
+                        # =============== backward ===============
+                        loss.backward()
                     optimizer.first_step(zero_grad=True)
 
-                    out_batch = self.network(x_batch)
-                    loss = self.criterion(out_batch, y_batch)
+                    # same batch as the first pass: the RevIN statistics computed there are still valid
+                    with self._autocast():
+                        out_batch = self.network(x_batch, reuse_stats=True)
+                        loss = self.criterion(out_batch, y_batch)
 
                     loss.backward()
                     optimizer.second_step(zero_grad=True)
                 else:
+                    with self._autocast():
+                        out_batch = self.network(x_batch)
+                        loss = self.criterion(out_batch, y_batch)
+
                     optimizer.zero_grad()
                     loss.backward()
                     optimizer.step()
-                loss_list.append(loss.item())
+                # losses are accumulated on the device to avoid a host sync per step
+                loss_sum += loss.detach()
             # =============== save model / update log ===============
-            train_loss = np.mean(loss_list)
+            if self.distributed:
+                # the reported loss is averaged over all the shards
+                torch.distributed.all_reduce(loss_sum)
+                train_loss = (loss_sum / (n_batches * world_size)).item()
+            else:
+                train_loss = (loss_sum / n_batches).item()
             self.network.train()
             progress_bar.set_description("Epoch {:d}: Train Loss {:.4f}".format(epoch, train_loss), refresh=True)
         return
 
     def forecast(self, x, batch_size=256):
         self.network.eval()
-        dataset = torch.utils.data.TensorDataset(torch.tensor(x, dtype=torch.float))
-        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+        network = self._inference_network()
+        x = torch.as_tensor(x, dtype=torch.float32)
         outs = []
-        for _, batch in enumerate(dataloader):
-            x = batch[0].to(self.device)
+        for i in range(0, x.shape[0], batch_size):
+            x_batch = self._to_device(x[i:i + batch_size])
+            n = x_batch.shape[0]
+            if self._compiled and n < batch_size:
+                # the tail batch is zero-padded so that the compiled network keeps a single batch shape
+                padding = x_batch.new_zeros((batch_size - n,) + tuple(x_batch.shape[1:]))
+                x_batch = torch.cat([x_batch, padding])
             with torch.no_grad():
-                out = self.network(x)
-            outs.append(out.cpu())
+                out = network(x_batch)[:n]
+            outs.append(out.to('cpu', non_blocking=True))
+        # the device-to-host copies are asynchronous: wait for all of them once
+        if self._device_type == 'cuda':
+            torch.cuda.synchronize(self.device)
         outs = torch.cat(outs)
-        return outs.cpu().numpy()
+        return outs.numpy()
+
+    def _inference_network(self):
+        # With script_inference=True, an eager (not compiled nor DDP-wrapped) network is replaced at inference time
+        # by a TorchScript copy of the architecture, sharing its parameters, to avoid the Python dispatch of every op
+        if not self.script_inference or self.network is not self._orig_network:
+            return self.network
+        if self._scripted_network is None:
+            self._scripted_network = torch.jit.script(self._orig_network)
+        self._scripted_network.eval()
+        return self._scripted_network
+
+    def _base_optimizer_kwargs(self):
+        # Multi-tensor updates: a single fused kernel on CUDA when available, foreach kernels otherwise
+        parameters = inspect.signature(self.base_optimizer).parameters
+        if 'fused' in parameters and self._device_type == 'cuda':
+            return {'fused': True}
+        if 'foreach' in parameters:
+            return {'foreach': True}
+        return {}
+
+    def _autocast(self):
+        # BF16 has the FP32 exponent range, so no gradient scaling is needed
+        return torch.autocast(device_type=self._device_type, dtype=torch.bfloat16,
+                              enabled=self.use_amp and self._device_type == 'cuda')
+
+    def _to_device(self, tensor):
+        # Host tensors are copied from pinned memory, so that the copy overlaps with the computation on CUDA
+        if tensor.device.type == 'cpu' and self._device_type == 'cuda':
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True)
 
     def predict(self, x, batch_size=256):
         return self.forecast(x, batch_size=batch_size)
@@ -138,33 +287,31 @@ class SAMFormer:
         # Perform forward pass to extract Q, K, V
         with torch.no_grad():
             if self.use_revin:
-                x_norm = self.network.revin(x.transpose(1, 2), mode='norm').transpose(1, 2)
+                x_norm = self._orig_network.revin(x, mode='norm')
             else:
                 x_norm = x
             
             # Queries, Keys, Values
-            queries = self.network.compute_queries(x_norm)  # (n, D, hid_dim)
-            keys = self.network.compute_keys(x_norm)        # (n, D, hid_dim)
-            values = self.network.compute_values(x_norm)    # (n, D, L)
+            queries, keys, values = self._orig_network.compute_qkv(x_norm)  # (n, D, hid_dim), (n, D, hid_dim), (n, D, L)
             
             # Attention matrix Q*K^T
-            if hasattr(torch.nn.functional, 'scaled_dot_product_attention'):
-                att_score = torch.nn.functional.scaled_dot_product_attention(queries, keys, values)
-            else:
-                att_score = scaled_dot_product_attention(queries, keys, values)
+            att_score = _sdpa(queries, keys, values)
             
             # X after attention projection
             out = x_norm + att_score  # Residual connection
-            out_proj = self.network.linear_forecaster(out)
+            out_proj = self._orig_network.linear_forecaster(out)
             
         return x, queries, keys, values, att_score, out_proj
 
     def extract_weight_matrices(self):
-        W_Q = self.network.compute_queries.weight.detach().cpu().numpy()  # (512, 16)
-        W_K = self.network.compute_keys.weight.detach().cpu().numpy()     # (512, 16)
-        W_V = self.network.compute_values.weight.detach().cpu().numpy()   # (512, 512)
-        W_O = self.network.linear_forecaster.weight.detach().cpu().numpy() # (512, 96)
-        return W_Q, W_K, W_V, W_O
+        return tuple(_to_numpy(self._weight_matrices()))
+
+    def _weight_matrices(self):
+        hid_dim, seq_len = self._orig_network.hid_dim, self._orig_network.seq_len
+        W_Q, W_K, W_V = self._orig_network.qkv.weight.split([hid_dim, hid_dim, seq_len], dim=0)
+        # (16, 512), (16, 512), (512, 512)
+        W_O = self._orig_network.linear_forecaster.weight # (512, 96)
+        return [W_Q, W_K, W_V, W_O]
 
     def plot_heatmap(self, matrix, title):
         plt.figure(figsize=(10, 6))
@@ -178,24 +325,28 @@ class SAMFormer:
         attention_matrix = torch.bmm(queries, keys.transpose(1, 2)) / np.sqrt(queries.shape[-1])
         attention_weights = nn.functional.softmax(attention_matrix, dim=-1)
         
+        # Move everything to the host at once
+        (x, queries, keys, values, attention_weights, att_score, out_proj,
+         W_Q, W_K, W_V, W_O) = _to_numpy([x[0], queries[0], keys[0], values[0], attention_weights[0], att_score[0],
+                                          out_proj[0]] + self._weight_matrices())
+
         # Plot input X
-        self.plot_heatmap(x[0].cpu().numpy(), "Input Matrix (X) for 1 Batch")
+        self.plot_heatmap(x, "Input Matrix (X) for 1 Batch")
         
         # Plot Q, K, V
-        self.plot_heatmap(queries[0].cpu().numpy(), "Query Matrix (Q) for 1 Batch")
-        self.plot_heatmap(keys[0].cpu().numpy(), "Key Matrix (K) for 1 Batch")
-        self.plot_heatmap(values[0].cpu().numpy(), "Value Matrix (V) for 1 Batch")
+        self.plot_heatmap(queries, "Query Matrix (Q) for 1 Batch")
+        self.plot_heatmap(keys, "Key Matrix (K) for 1 Batch")
+        self.plot_heatmap(values, "Value Matrix (V) for 1 Batch")
         
         # Plot Attention Matrix (Q*K^T)
-        self.plot_heatmap(attention_weights[0].cpu().numpy(), "Attention Matrix (Q * K^T) for 1 Batch")
+        self.plot_heatmap(attention_weights, "Attention Matrix (Q * K^T) for 1 Batch")
         #Plot Attention Matrix (Q*K^T)*V
-        self.plot_heatmap(att_score[0].cpu().numpy(), "Attention Score (Q*K^T)*V for 1 Batch")
+        self.plot_heatmap(att_score, "Attention Score (Q*K^T)*V for 1 Batch")
         
         # Plot X after attention projection
-        self.plot_heatmap(out_proj[0].cpu().numpy(), "Output Projection for 1 Batch")
+        self.plot_heatmap(out_proj, "Output Projection for 1 Batch")
         
-        # Extract and plot weight matrices
-        W_Q, W_K, W_V, W_O = self.extract_weight_matrices()
+        # Plot weight matrices
         self.plot_heatmap(W_Q, "Projection Matrix W_Q")
         self.plot_heatmap(W_K, "Projection Matrix W_K")
         self.plot_heatmap(W_V, "Projection Matrix W_V")
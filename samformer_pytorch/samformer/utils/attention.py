@@ -1,14 +1,20 @@
+import math
 import torch
 
-import numpy as np
+from typing import Optional
 
 
-def scaled_dot_product_attention(query, key, value, attn_mask=None, dropout_p=0.0, is_causal=False, scale=None):
+def scaled_dot_product_attention(query, key, value, attn_mask: Optional[torch.Tensor] = None, dropout_p: float = 0.0,
+                                 is_causal: bool = False, scale: Optional[float] = None):
     """
     A copy-paste from https://pytorch.org/docs/stable/generated/torch.nn.functional.scaled_dot_product_attention.html
+    Type-annotated so that it can be compiled by TorchScript
     """
     L, S = query.size(-2), key.size(-2)
-    scale_factor = 1 / np.sqrt(query.size(-1)) if scale is None else scale
+    if scale is None:
+        scale_factor = 1 / math.sqrt(query.size(-1))
+    else:
+        scale_factor = scale
     attn_bias = torch.zeros(L, S, dtype=query.dtype, device=query.device)
     if is_causal:
         assert attn_mask is None
@@ -1,12 +1,66 @@
 import torch
 import torch.nn as nn
 
+from typing import Optional
+
+
+try:
+    from torch.compiler import is_compiling as _is_compiling
+except ImportError:
+    try:
+        from torch._dynamo import is_compiling as _is_compiling
+    except ImportError:
+        def _is_compiling():
+            return False
+
+
+def _normalize_eager(x, mean, inv_stdev, affine_weight: Optional[torch.Tensor],
+                     affine_bias: Optional[torch.Tensor]):
+    x = (x - mean) * inv_stdev
+    if affine_weight is not None and affine_bias is not None:
+        x = x * affine_weight.unsqueeze(-1) + affine_bias.unsqueeze(-1)
+    return x
+
+
+def _denormalize_eager(x, mean, inv_stdev, affine_weight: Optional[torch.Tensor],
+                       affine_bias: Optional[torch.Tensor], eps: float):
+    if affine_weight is not None and affine_bias is not None:
+        x = (x - affine_bias.unsqueeze(-1)) / (affine_weight.unsqueeze(-1) + eps*eps)
+    return x / inv_stdev + mean
+
+
+# Scripted copies, which the TorchScript fuser turns into a single elementwise kernel each. The fuser only does so on
+# CUDA, and torch.compile traces the Python source itself, so they are used for eager CUDA inputs only
+_normalize_fused = torch.jit.script(_normalize_eager)
+_denormalize_fused = torch.jit.script(_denormalize_eager)
+
+
+@torch.jit.unused
+def _can_fuse(x: torch.Tensor) -> bool:
+    return x.is_cuda and not _is_compiling()
+
+
+def _normalize(x, mean, inv_stdev, affine_weight: Optional[torch.Tensor], affine_bias: Optional[torch.Tensor]):
+    if not torch.jit.is_scripting() and _can_fuse(x):
+        return _normalize_fused(x, mean, inv_stdev, affine_weight, affine_bias)
+    return _normalize_eager(x, mean, inv_stdev, affine_weight, affine_bias)
+
+
+def _denormalize(x, mean, inv_stdev, affine_weight: Optional[torch.Tensor], affine_bias: Optional[torch.Tensor],
+                 eps: float):
+    if not torch.jit.is_scripting() and _can_fuse(x):
+        return _denormalize_fused(x, mean, inv_stdev, affine_weight, affine_bias, eps)
+    return _denormalize_eager(x, mean, inv_stdev, affine_weight, affine_bias, eps)
+
 
 class RevIN(nn.Module):
     """
     Reversible Instance Normalization (RevIN) https://openreview.net/pdf?id=cGDAkQo1C0p
     https://github.com/ts-kim/RevIN
+    Operates on channel-first inputs of shape (batch, num_features, seq_len).
     """
+    affine: torch.jit.Final[bool]
+
     def __init__(self, num_features: int, eps=1e-5, affine=True):
         """
         :param num_features: the number of features or channels
@@ -19,10 +73,17 @@ class RevIN(nn.Module):
         self.affine = affine
         if self.affine:
             self._init_params()
+        # statistics of the last normalized input, declared here so that the module can be scripted
+        self.mean = torch.zeros(1)
+        self.inv_stdev = torch.ones(1)
 
-    def forward(self, x, mode:str):
+    def forward(self, x, mode:str, reuse_stats:bool=False):
+        """
+        :param reuse_stats: if True, 'norm' reuses the statistics of the previous call instead of recomputing them
+        """
         if mode == 'norm':
-            self._get_statistics(x)
+            if not reuse_stats:
+                self._get_statistics(x)
             x = self._normalize(x)
         elif mode == 'denorm':
             x = self._denormalize(x)
@@ -35,22 +96,18 @@ class RevIN(nn.Module):
         self.affine_bias = nn.Parameter(torch.zeros(self.num_features))
 
     def _get_statistics(self, x):
-        dim2reduce = tuple(range(1, x.ndim-1))
-        self.mean = torch.mean(x, dim=dim2reduce, keepdim=True).detach()
-        self.stdev = torch.sqrt(torch.var(x, dim=dim2reduce, keepdim=True, unbiased=False) + self.eps).detach()
+        # statistics are computed over the time axis, which is the last one
+        # in a single pass, and kept in FP32 under mixed precision
+        var, mean = torch.var_mean(x.float(), dim=-1, keepdim=True, unbiased=False)
+        self.mean = mean.detach()
+        self.inv_stdev = torch.rsqrt(var + self.eps).detach()
 
     def _normalize(self, x):
-        x = x - self.mean
-        x = x / self.stdev
         if self.affine:
-            x = x * self.affine_weight
-            x = x + self.affine_bias
-        return x
+            return _normalize(x, self.mean, self.inv_stdev, self.affine_weight, self.affine_bias)
+        return _normalize(x, self.mean, self.inv_stdev, None, None)
 
     def _denormalize(self, x):
         if self.affine:
-            x = x - self.affine_bias
-            x = x / (self.affine_weight + self.eps*self.eps)
-        x = x * self.stdev
-        x = x + self.mean
-        return x
+            return _denormalize(x, self.mean, self.inv_stdev, self.affine_weight, self.affine_bias, self.eps)
+        return _denormalize(x, self.mean, self.inv_stdev, None, None, self.eps)